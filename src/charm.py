@@ -2,55 +2,111 @@
 # Copyright 2022 pietro
 # See LICENSE file for licensing details.
 
+import hashlib
 import json
 import logging
-from itertools import chain
-from typing import Optional, List
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Iterator, Optional, List, Tuple, TYPE_CHECKING
 
 from ops.charm import CharmBase
+from ops.framework import StoredState
 from ops.main import main
 from ops.model import (
-    ActiveStatus, WaitingStatus, Relation, MaintenanceStatus, Container
+    ActiveStatus, WaitingStatus, Relation, MaintenanceStatus, Container,
+    ModelError
 )
 from ops.pebble import Layer
 
+if TYPE_CHECKING:
+    import requests
+
 logger = logging.getLogger(__name__)
 
+# sentinel for cached values which have not been looked up yet
+_MISSING = object()
+
+# the static part of the char pebble layer; only the environment is filled in
+_CHAR_LAYER_TEMPLATE = {
+    "summary": "char layer",
+    "description": "pebble config layer for char",
+    "services": {
+        "char": {
+            "override": "merge",
+            "summary": "char service",
+            "command": "./main.sh",
+            "startup": "enabled",
+        }
+    },
+}
+
+
+@lru_cache(maxsize=1)
+def _get_session() -> 'requests.Session':
+    """The http session shared across actions, so that connections to the
+    chars are kept alive and reused.
+    requests is only imported here: most hooks never need it, and the charm
+    is re-executed (and re-imported) for every event.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_connections=32, pool_maxsize=32))
+    return session
+
 
 class CharCharm(CharmBase):
     """Charm the service."""
     _container_name = _layer_name = _service_name = "char"
     _peer_relation_name = "replicas"
     _address_name = 'private-address-ip'
-    _port = 8080
+    _stored = StoredState()
 
     def __init__(self, *args):
         super().__init__(*args)
 
         self.container: Container = self.unit.get_container(
             self._container_name)
-
-        # Core lifecycle events
-        self.framework.observe(self.on.config_changed, self._update)
-        self.framework.observe(self.on.char_pebble_ready, self._update)
-        self.framework.observe(self.on.start, self._on_start)
-
-        # Peer relation events
-        self.framework.observe(
-            self.on[self._peer_relation_name].relation_joined,
-            self._update
-        )
-        self.framework.observe(
-            self.on[self._peer_relation_name].relation_changed,
-            self._update
+        # (key, layer) of the last layer built by _char_layer
+        self._layer_cache: Optional[Tuple[tuple, Layer]] = None
+        # digest of the last layer we know to be in the pebble plan; kept
+        # across dispatches so that no-op events don't need to ask pebble
+        self._stored.set_default(layer_hash="")
+        # set by any event requiring an _update; flushed once on pre-commit
+        self._update_pending = False
+        # hook-tool lookups, cached until the next event is handled
+        self._reset_lookups()
+
+        peers = self.on[self._peer_relation_name]
+        observers = (
+            # Core lifecycle events
+            (self.on.config_changed, self._schedule_update),
+            (self.on.char_pebble_ready, self._on_pebble_ready),
+            (self.on.start, self._on_start),
+            # Peer relation events
+            (peers.relation_joined, self._schedule_update),
+            (peers.relation_changed, self._schedule_update),
+            # Framework events: pre_commit, not commit, so that the _update's
+            # StoredState changes are still persisted
+            (self.framework.on.pre_commit, self._flush_update),
+            # Action events
+            (self.on.war_action, self._on_war_action),
+            (self.on.respawn_action, self._on_respawn_action),
+            (self.on.glob_status_action, self._on_glob_status_action),
         )
+        observe = self.framework.observe
+        for event, handler in observers:
+            observe(event, handler)
+
+    @property
+    def _service_port(self) -> int:
+        """The port all chars in this application listen on."""
+        return self.config["port"]
 
-        # Action events
-        self.framework.observe(self.on.war_action, self._on_war_action)
-        self.framework.observe(self.on.respawn_action, self._on_respawn_action)
-        self.framework.observe(self.on.glob_status_action,
-                               self._on_glob_status_action)
+    @property
+    def _war_url(self) -> str:
+        return f"http://localhost:{self._service_port}/attack/?damage=1"
 
     @property
     def enemies(self) -> List[str]:
@@ -58,33 +114,38 @@ class CharCharm(CharmBase):
 
     # Actual char stuff
     def _char_layer(self):
-        """Returns a Pebble configration layer for Char"""
+        """Returns a Pebble configration layer for Char.
+        The layer is memoized on the peers and config it is built from, so
+        repeated calls within an event don't rebuild it.
+        """
+        peers = self.enemies
+        cfg = self.config
+        port, name, host, loglevel = (
+            cfg["port"], cfg["name"], cfg["host"], cfg["loglevel"])
+        key = (tuple(peers), port, name, host, loglevel)
+        if self._layer_cache and self._layer_cache[0] == key:
+            return self._layer_cache[1]
 
-        enemies = ';'.join(self.enemies)
+        enemies = ';'.join(peers)
 
         env = {
             "ENEMIES": enemies,
-            "UVICORN_PORT": self.config["port"],
-            "UVICORN_HOST": self.config["host"],
-            "NAME": self.config["name"],
-            "LOGLEVEL": self.config["loglevel"],
+            "UVICORN_PORT": port,
+            "UVICORN_HOST": host,
+            "NAME": name,
+            "LOGLEVEL": loglevel,
         }
-        logging.info(f"Initing pebble layer with env: {str(env)}")
-        logging.info(f"Enemies: {enemies}")
+        logger.debug("Initing pebble layer with env: %s", env)
 
-        return Layer({
-            "summary": "char layer",
-            "description": "pebble config layer for char",
+        layer = Layer({
+            **_CHAR_LAYER_TEMPLATE,
             "services": {
-                "char": {
-                    "override": "merge",
-                    "summary": "char service",
-                    "command": "./main.sh",
-                    "startup": "enabled",
-                    "environment": env,
-                }
+                "char": {**_CHAR_LAYER_TEMPLATE["services"]["char"],
+                         "environment": env}
             },
         })
+        self._layer_cache = (key, layer)
+        return layer
 
     # source: https://github.com/canonical/alertmanager-k8s-operator
     def _restart_service(self) -> bool:
@@ -98,50 +159,78 @@ class CharCharm(CharmBase):
             logger.error("Cannot (re)start service: container is not ready.")
             return False
 
-        # Check if service exists, to avoid ModelError from being raised when the service does
-        # not exist,
-        if not self.container.get_plan().services.get(self._service_name):
+        # Check if service exists, to avoid ModelError from being raised by restart when the
+        # service does not exist. Only this service is queried, not the whole plan.
+        try:
+            self.container.get_service(self._service_name)
+        except ModelError:
             logger.error(
                 "Cannot (re)start service: service does not (yet) exist.")
             return False
 
-        logger.info(
-            f"pebble env, {self.container.get_plan().services.get('char').environment}")
-
         self.container.restart(self._service_name)
-        logger.info(f'restarted {self._service_name}')
+        logger.info('restarted %s', self._service_name)
         return True
 
-    def _update_layer(self, restart: bool) -> bool:
+    def _update_layer(self, replan: bool) -> bool:
         """Update service layer to reflect changes in peers (replicas).
         Args:
-          restart: a flag indicating if the service should be restarted if a change was detected.
+          replan: a flag indicating if pebble should replan if a change was detected, restarting
+            the service only if its configuration changed.
         Returns:
           True if anything changed; False otherwise
         """
         overlay = self._char_layer()
+        layer_hash = self._layer_hash(overlay)
+        if layer_hash == self._stored.layer_hash:
+            # this very overlay is already in the plan: no need to ask pebble
+            return False
+
         plan = self.container.get_plan()
 
         logger.info('updating layer')
 
-        if self._service_name not in plan.services or overlay.services != plan.services:
+        # only our own service matters: other layers may add services to the plan
+        current = plan.services.get(self._service_name)
+        if current is None or current != overlay.services[self._service_name]:
             logger.info('container.add_layer')
             self.container.add_layer(self._layer_name, overlay, combine=True)
+            self._stored.layer_hash = layer_hash
 
-            if restart:
-                self._restart_service()
+            if replan:
+                self.container.replan()
+                logger.info('replanned %s', self._service_name)
 
             return True
 
+        self._stored.layer_hash = layer_hash
         return False
 
+    @staticmethod
+    def _layer_hash(layer: Layer) -> str:
+        """Stable digest of a pebble layer, for cheap change detection."""
+        dump = json.dumps(layer.to_dict(), sort_keys=True).encode()
+        return hashlib.blake2b(dump, digest_size=16).hexdigest()
+
+    def _reset_lookups(self):
+        """Forget the cached peer relation and private address.
+        Called on entry of the handlers using them: ops uses a new charm instance per
+        dispatch, but the Harness reuses one across events.
+        """
+        self._peer_relation = _MISSING
+        self._private_address = _MISSING
+
     @property
     def peer_relation(self) -> Relation:
         """Helper function for obtaining the peer relation object.
         Returns: peer relation object
         (NOTE: would return None if called too early, e.g. during install).
+        The relation is looked up once per event (see _reset_lookups).
         """
-        return self.model.get_relation(self._peer_relation_name)
+        if self._peer_relation is _MISSING:
+            self._peer_relation = self.model.get_relation(
+                self._peer_relation_name)
+        return self._peer_relation
 
     @property
     def private_address(self) -> Optional[str]:
@@ -157,14 +246,18 @@ class CharCharm(CharmBase):
         Returns:
           None if no IP is available (called before unit "joined"); unit's ip address otherwise
         """
+        # Only an actual address is cached, so a None is looked up again.
+        if self._private_address is not _MISSING:
+            return self._private_address
 
         # if bind_address := check_output(["unit-get", "private-address"]).decode().strip()
         if bind_address := self.model.get_binding(self._peer_relation_name
                                                   ).network.bind_address:
-            bind_address = str(bind_address)
+            bind_address = self._private_address = str(bind_address)
         return bind_address
 
     def _on_start(self, _):
+        self._reset_lookups()
         if not (peer_relation := self.peer_relation):
             self.unit.status = WaitingStatus(
                 "waiting for peer relation to show up")
@@ -174,12 +267,38 @@ class CharCharm(CharmBase):
 
     def update_address_in_relation_data(self, relation):
         """stores this unit's private IP in the relation databag"""
-        relation.data[self.unit].update(
-            {self._address_name: self.private_address})
-        logger.info(f'stored {self.private_address} in relation databag')
+        address = self.private_address
+        databag = relation.data[self.unit]
+        # each write is a relation-set call: skip it if nothing changed
+        if databag.get(self._address_name) == address:
+            return
+        databag[self._address_name] = address
+        logger.info('stored %s in relation databag', address)
+
+    def _on_pebble_ready(self, event):
+        """A (re)started container comes with an empty plan: forget what we
+        know to have applied to the previous one."""
+        if self._stored.layer_hash:
+            self._stored.layer_hash = ""
+        self._schedule_update(event)
+
+    def _schedule_update(self, _):
+        """Marks an _update as pending.
+        Several events requiring an update may fire within a single dispatch;
+        they are coalesced into one _update, run on pre-commit.
+        """
+        self._reset_lookups()
+        self._update_pending = True
+
+    def _flush_update(self, _):
+        """Runs the pending _update, if any."""
+        if self._update_pending:
+            self._update_pending = False
+            self._reset_lookups()
+            self._update(None)
 
     def _update(self, _):
-        """Event handler for ConfigChangedEvent."""
+        """Updates the char layer and unit status."""
         logger.info('running _update')
         if not self.container.can_connect():
             self.unit.status = MaintenanceStatus(
@@ -207,21 +326,25 @@ class CharCharm(CharmBase):
         self.unit.status = ActiveStatus()
         return
 
-    def _get_peer_addresses(self) -> List[str]:
-        """Create a list of HA addresses of all peer units (all units excluding current).
-        The returned addresses include the HA port number but do not include scheme (http).
-        If a unit does not have an address, it will be omitted from the list.
+    def _iter_peer_addresses(self) -> Iterator[str]:
+        """Yield the HA addresses of all peer units (all units excluding current).
+        The addresses include the HA port number but do not include scheme (http).
+        If a unit does not have an address, it will be omitted.
         """
-        addresses = []
         if pr := self.peer_relation:
-            addresses = [
-                f"{address}:{self._port}"
+            yield from (
+                f"{address}:{self._service_port}"
                 for unit in pr.units
                 # pr.units only holds peers (self.unit is not included)
                 if (address := pr.data[unit].get(self._address_name))
-            ]
+            )
 
-        return addresses
+    def _get_peer_addresses(self) -> List[str]:
+        """Create a sorted list of the addresses from _iter_peer_addresses.
+        The addresses are sorted, so that the layer built from them doesn't
+        depend on the (arbitrary) order of pr.units.
+        """
+        return sorted(self._iter_peer_addresses())
 
     # ACTIONS
     def _on_war_action(self, event):
@@ -229,12 +352,11 @@ class CharCharm(CharmBase):
         lash out to all other chars in sight, which will retaliate, etc...
         https://juju.is/docs/sdk/actions
         """
-        url = f"http://localhost:{self._port}/attack/?damage=1"
         try:
-            requests.post(url)
+            _get_session().post(self._war_url, timeout=(1, 2))
         except Exception as e:
-            logger.error(f"failed to contact the local char server; check "
-                         f"your connectivity! {e}")
+            logger.error("failed to contact the local char server; check "
+                         "your connectivity! %s", e)
         event.set_results({'result': 1})
 
     def _on_respawn_action(self, event):
@@ -246,19 +368,32 @@ class CharCharm(CharmBase):
     def _on_glob_status_action(self, event):
         """ reports the status of all chars in the cluster
         """
+        import requests
+
+        self._reset_lookups()
         statuses = {}
+        session = _get_session()
 
         def get_name_and_hp(url):
-            resp = requests.get(url + '/status')
-            jsn = resp.json()
-            return jsn['name'], jsn['hp']
-
-        for host in chain(['localhost:8080'], self.enemies):
-            name, hp = get_name_and_hp(f"http://{host}")
-            statuses[f"{name}@{host}"] = hp
-
-        logging.info(f"SITREP:"
-                     f"{json.dumps(statuses, indent=2)}")
+            # a dead or stalled char must not abort the whole sitrep
+            try:
+                resp = session.get(url + '/status', timeout=(1, 3))
+                jsn = resp.json()
+                return jsn['name'], jsn['hp']
+            except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+                logger.warning("no valid status from char at %s: %s", url, e)
+                return '?', 'unreachable'
+
+        # the chars are queried concurrently: this is all network wait
+        hosts = (f'localhost:{self._service_port}', *self._iter_peer_addresses())
+        with ThreadPoolExecutor(max_workers=min(32, len(hosts))) as executor:
+            results = executor.map(
+                lambda host: (host, get_name_and_hp(f"http://{host}")), hosts)
+            for host, (name, hp) in results:
+                statuses[f"{name}@{host}"] = hp
+
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("SITREP:%s", json.dumps(statuses, indent=2))
         event.set_results({'result': 1})
 
 
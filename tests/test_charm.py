@@ -4,32 +4,73 @@
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 from charm import CharCharm
 from ops.model import ActiveStatus, Network
 from ops.testing import Harness
 
+# shared by the action tests; reset before each of them
+_FAKE_ACTION = Mock(params={"fail": ""})
+
+
+class TestCharmActions(unittest.TestCase):
+    # the actions don't touch the charm's state, so the tests can share a harness
+    @classmethod
+    def setUpClass(cls):
+        cls.harness = Harness(CharCharm)
+        cls.addClassCleanup(cls.harness.cleanup)
+        cls.harness.begin()
 
-class TestCharm(unittest.TestCase):
     def setUp(self):
-        self.harness = Harness(CharCharm)
-        self.addCleanup(self.harness.cleanup)
-        self.harness.begin()
+        _FAKE_ACTION.reset_mock()
 
     def test_war_action(self):
         # the harness doesn't (yet!) help much with actions themselves
-        action_event = Mock(params={"fail": ""})
-        self.harness.charm._on_war_action(action_event)
+        self.harness.charm._on_war_action(_FAKE_ACTION)
 
-        self.assertTrue(action_event.set_results.called)
+        self.assertTrue(_FAKE_ACTION.set_results.called)
 
     def test_respawn_action(self):
         # the harness doesn't (yet!) help much with actions themselves
-        action_event = Mock(params={"fail": ""})
-        self.harness.charm._on_respawn_action(action_event)
+        self.harness.charm._on_respawn_action(_FAKE_ACTION)
+
+        self.assertTrue(_FAKE_ACTION.set_results.called)
+
+    @patch('charm._get_session')
+    def test_glob_status_action(self, get_session):
+        session = get_session.return_value
+        session.get.return_value.json.return_value = {'name': 'hero', 'hp': 10}
+        self.harness.charm._on_glob_status_action(_FAKE_ACTION)
+
+        session.get.assert_called_once_with(
+            'http://localhost:8080/status', timeout=(1, 3))
+        self.assertTrue(_FAKE_ACTION.set_results.called)
+
+    @patch('charm._get_session')
+    def test_glob_status_action_unreachable(self, get_session):
+        import requests
+        session = get_session.return_value
+        session.get.side_effect = requests.ConnectionError('dead char')
+        self.harness.charm._on_glob_status_action(_FAKE_ACTION)
 
-        self.assertTrue(action_event.set_results.called)
+        self.assertTrue(_FAKE_ACTION.set_results.called)
+
+    @patch('charm._get_session')
+    def test_glob_status_action_malformed(self, get_session):
+        session = get_session.return_value
+        for reply in ({}, []):
+            session.get.return_value.json.return_value = reply
+            self.harness.charm._on_glob_status_action(_FAKE_ACTION)
+
+        self.assertEqual(_FAKE_ACTION.set_results.call_count, 2)
+
+
+class TestCharmConfig(unittest.TestCase):
+    def setUp(self):
+        self.harness = Harness(CharCharm)
+        self.addCleanup(self.harness.cleanup)
+        self.harness.begin()
 
     def test_config_changed(self):
         def get_plan():
@@ -53,6 +94,9 @@ class TestCharm(unittest.TestCase):
         self.harness.charm.model.get_binding = Mock(return_value=binding)
 
         self.harness.update_config({'enemies': '123;456'})
+        # the update is deferred until the framework commits (on pre-commit)
+        self.assertEqual(get_plan().to_dict(), {})
+        self.harness.framework.commit()
 
         plan = get_plan()
         expected = self.harness.charm._char_layer().to_dict()
@@ -64,3 +108,70 @@ class TestCharm(unittest.TestCase):
 
         container = self.harness.model.unit.get_container('char')
         self.assertTrue(container.get_service('char').is_running())
+
+    def test_layer_hash_persisted_on_commit(self):
+        binding = Mock(network=Network({'bind-addresses': [
+            {'interface-name': 'foo', 'addresses': [{'value': '0.0.0.0'}]}
+        ]}))
+        self.harness.charm.model.get_binding = Mock(return_value=binding)
+
+        self.harness.update_config({'name': 'ork'})
+        self.harness.framework.commit()
+
+        stored = self.harness.charm._stored
+        snapshot = self.harness.framework._storage.load_snapshot(
+            stored._data.handle.path)
+        self.assertTrue(stored.layer_hash)
+        self.assertEqual(snapshot['layer_hash'], stored.layer_hash)
+
+    def test_enemies_follow_peer_relation(self):
+        self.assertEqual(self.harness.charm.enemies, [])
+        self.assertIsNone(self.harness.charm.peer_relation)
+
+        rel_id = self.harness.add_relation('replicas', 'char-operator')
+        self.harness.add_relation_unit(rel_id, 'char-operator/1')
+        self.harness.update_relation_data(
+            rel_id, 'char-operator/1', {'private-address-ip': '10.0.0.2'})
+
+        self.assertEqual(self.harness.charm.enemies, ['10.0.0.2:8080'])
+
+    def test_port_config(self):
+        with self.harness.hooks_disabled():
+            self.harness.update_config({'port': 9000})
+
+        charm = self.harness.charm
+        self.assertEqual(charm._war_url, 'http://localhost:9000/attack/?damage=1')
+        env = charm._char_layer().services['char'].environment
+        self.assertEqual(env['UVICORN_PORT'], 9000)
+
+    def test_char_layer_memoized(self):
+        layer = self.harness.charm._char_layer()
+        self.assertIs(self.harness.charm._char_layer(), layer)
+
+        with self.harness.hooks_disabled():
+            self.harness.update_config({'name': 'ork'})
+        self.assertIsNot(self.harness.charm._char_layer(), layer)
+
+    def test_updates_coalesced(self):
+        self.harness.charm._update = Mock()
+        self.harness.update_config({'name': 'ork'})
+        self.harness.update_config({'name': 'elf'})
+        self.harness.charm.on.char_pebble_ready.emit(
+            self.harness.charm.container)
+        self.harness.charm._update.assert_not_called()
+
+        self.harness.framework.commit()
+        self.harness.charm._update.assert_called_once()
+
+    def test_update_layer_skips_pebble_if_applied(self):
+        charm = self.harness.charm
+        self.assertTrue(charm._update_layer(False))
+        self.assertTrue(charm._stored.layer_hash)
+
+        charm.container.get_plan = Mock()
+        self.assertFalse(charm._update_layer(False))
+        charm.container.get_plan.assert_not_called()
+
+        # a new container has an empty plan, whatever we applied before
+        charm._on_pebble_ready(Mock())
+        self.assertEqual(charm._stored.layer_hash, "")